@@ -0,0 +1,36 @@
+"""
+Optional numba kernel for the duplicate check over the conformers,
+which terminates early, as soon as a duplicate is found.
+
+The clashes are instead found with the KD-tree of the protein,
+which is faster than comparing against all the protein atoms.
+"""
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+numba_available = njit is not None
+
+if numba_available:
+
+    @njit(fastmath=True, cache=True)
+    def duplicate_conformer(coords, new_coords, rms_limit):
+        """
+        Check if the new conformer (atoms, 3) is within the rms_limit
+        of any of the prealigned conformers (conformers, atoms, 3).
+        """
+        # compare the sum of the squared distances rather than the RMS
+        max_ssd = rms_limit * rms_limit * new_coords.shape[0]
+        for c in range(coords.shape[0]):
+            ssd = 0.0
+            for i in range(new_coords.shape[0]):
+                dx = coords[c, i, 0] - new_coords[i, 0]
+                dy = coords[c, i, 1] - new_coords[i, 1]
+                dz = coords[c, i, 2] - new_coords[i, 2]
+                ssd += dx * dx + dy * dy + dz * dz
+                if ssd >= max_ssd:
+                    break
+            if ssd < max_ssd:
+                return True
+        return False
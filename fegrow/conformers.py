@@ -2,21 +2,79 @@ import random
 from copy import deepcopy
 from typing import List, Optional
 
+import numpy as np
 from rdkit import Chem
+from scipy.spatial import cKDTree
 from rdkit.Chem import AllChem, rdFMCS
 
+# optional GPU embedding
+try:
+    from nvmolkit.embedMolecules import EmbedMolecules as nvEmbedMolecules
+except ImportError:
+    nvEmbedMolecules = None
+
+# the largest RMS (in Angstroms) of the tethered core for the nvMolKit conformers
+NVMOLKIT_MAX_TETHER_RMS = 0.1
+
+
+def conformer_coordinates(m: Chem.rdchem.Mol) -> np.ndarray:
+    """
+    The coordinates of all the conformers as one contiguous array
+    of the shape (conformers, atoms, 3).
+    """
+    coords = np.empty((m.GetNumConformers(), m.GetNumAtoms(), 3))
+    for i, conformer in enumerate(m.GetConformers()):
+        coords[i] = conformer.GetPositions()
+    return coords
+
+
+def protein_tree(prot) -> cKDTree:
+    """
+    Index the protein atoms for the clash checks.
+
+    :param prot: A prody instance, or an already built cKDTree which is returned as is.
+    """
+    if isinstance(prot, cKDTree):
+        return prot
+
+    return cKDTree(prot.getCoords())
+
+
+def clashing_conformers(
+    coords: np.ndarray, prot_tree: cKDTree, min_dst_allowed: float
+) -> np.ndarray:
+    """
+    For each conformer (conformers, atoms, 3), check if any atom
+    is closer than min_dst_allowed to any of the protein atoms.
+    """
+    # for each atom in every conformer find the closest protein atom in one query
+    dsts = prot_tree.query(coords.reshape(-1, 3))[0].reshape(coords.shape[:2])
+    return dsts.min(axis=1, initial=np.inf) < min_dst_allowed
+
+
+def conformers_rms(coords: np.ndarray, new_coords: np.ndarray) -> np.ndarray:
+    """
+    The RMS between the new conformer (atoms, 3) and each of the
+    prealigned conformers (conformers, atoms, 3), without any alignment.
+    """
+    return np.sqrt(((coords - new_coords) ** 2).sum(axis=2).mean(axis=1))
+
 
 def duplicate_conformers(
-    m: Chem.rdchem.Mol, new_conf_idx: int, rms_limit: float = 0.5
+    coords: np.ndarray, new_coords: np.ndarray, rms_limit: float = 0.5
 ) -> bool:
-    rmslist = []
-    for conf_idx in range(m.GetNumConformers()):
-        if conf_idx == new_conf_idx:
-            continue
-        rms = AllChem.GetConformerRMS(m, new_conf_idx, conf_idx, prealigned=True)
-        rmslist.append(rms)
-    # True if it is too similar to any already generated conformers
-    return any(rms < rms_limit for rms in rmslist)
+    """
+    Check if the new conformer (atoms, 3) is within the rms_limit
+    of any of the prealigned conformers (conformers, atoms, 3).
+    """
+    # numba is slow to import, so only import it once the duplicates are checked
+    from . import _kernels
+
+    if _kernels.numba_available:
+        return _kernels.duplicate_conformer(coords, new_coords, rms_limit)
+
+    rmslist = conformers_rms(coords, new_coords)
+    return bool((rmslist < rms_limit).any())
 
 
 def generate_conformers(
@@ -24,10 +82,101 @@ def generate_conformers(
     num_conf: int,
     minimum_conf_rms: Optional[float] = None,
     flexible: Optional[List[int]] = [],
+    backend: str = "rdkit",
+    prot=None,
+    min_dst_allowed: float = 1.0,
 ) -> List[Chem.rdchem.Mol]:
     """
     flexible:
             The list of atomic indices on the @core_ligand that should not be constrained during the conformer generation
+    backend:
+            "rdkit" embeds each conformer with the template coordinates constrained.
+            "nvmolkit" embeds the conformers on the GPU, see generate_conformers_nvmolkit.
+    prot:
+            The protein (prody instance or a cKDTree of its coordinates). When provided,
+            the conformers with any atom closer than min_dst_allowed to the protein
+            are discarded as they are generated, before the duplicates are checked.
+    """
+    if backend == "nvmolkit":
+        return generate_conformers_nvmolkit(
+            [RMol], num_conf, minimum_conf_rms, flexible, prot, min_dst_allowed
+        )[0]
+    elif backend != "rdkit":
+        raise ValueError(f'Unknown backend "{backend}", please chose "rdkit" or "nvmolkit"')
+
+    rmol, template_mol, coordMap, match, manmap = _match_template(RMol, flexible)
+
+    # use a reproducible random seed
+    randomseed = 194715
+
+    conformers = _embed_rdkit(
+        rmol, template_mol, coordMap, match, manmap, flexible, num_conf, randomseed
+    )
+    return _add_conformers(
+        rmol, conformers, num_conf, minimum_conf_rms, prot, min_dst_allowed
+    )
+
+
+def generate_conformers_nvmolkit(
+    RMols: List[Chem.rdchem.Mol],
+    num_conf: int,
+    minimum_conf_rms: Optional[float] = None,
+    flexible: Optional[List[int]] = [],
+    prot=None,
+    min_dst_allowed: float = 1.0,
+) -> List[Chem.rdchem.Mol]:
+    """
+    Embed the conformers of all the molecules in a single nvMolKit GPU batch,
+    see generate_conformers for the arguments.
+
+    nvMolKit does not support the coordinate map, so each conformer is aligned
+    and tethered to the template afterwards (on the CPU). Conformers that the tethers
+    cannot pull onto the template (e.g. with a flipped ring) are discarded.
+    """
+    if nvEmbedMolecules is None:
+        raise ImportError("The nvmolkit backend requires the nvMolKit package. ")
+
+    matched = [_match_template(RMol, flexible) for RMol in RMols]
+
+    embedded = []
+    for rmol, *_ in matched:
+        mol = deepcopy(rmol)
+        mol.RemoveAllConformers()
+        embedded.append(mol)
+
+    params = AllChem.ETKDGv3()
+    params.randomSeed = 194715
+    params.useRandomCoords = True
+    nvEmbedMolecules(embedded, params, confsPerMolecule=num_conf)
+
+    generated = []
+    for mol, (rmol, template_mol, _, _, manmap) in zip(embedded, matched):
+        tethered = []
+        for conformer in mol.GetConformers():
+            rms = _tether_to_core(mol, template_mol, manmap, confId=conformer.GetId())
+            if rms <= NVMOLKIT_MAX_TETHER_RMS:
+                tethered.append(conformer)
+
+        if len(tethered) < mol.GetNumConformers():
+            print(
+                f"Removed {mol.GetNumConformers() - len(tethered)} conformations "
+                f"that could not be tethered to the template. "
+            )
+
+        generated.append(
+            _add_conformers(
+                rmol, tethered, num_conf, minimum_conf_rms, prot, min_dst_allowed
+            )
+        )
+    return generated
+
+
+def _match_template(RMol, flexible):
+    """
+    Match the molecule to its template.
+
+    :returns: A copy of the molecule, the template, the coordinate map of the constrained atoms,
+        the match, and the pairs of the matched atoms (molecule, template).
     """
     # fixme - say something if the template has more than one conformer
     template_mol = deepcopy(RMol.template)
@@ -60,11 +209,61 @@ def generate_conformers(
         coordMap[matchedMolI] = corePtI
         manmap.append((matchedMolI, coreI))
 
-    # use a reproducible random seed
-    randomseed = 194715
+    return rmol, template_mol, coordMap, match, manmap
+
+
+def _add_conformers(rmol, conformers, num_conf, minimum_conf_rms, prot, min_dst_allowed):
+    """
+    Add the new conformers to the molecule, skipping the ones that clash with
+    the protein (if given) and the ones too similar to the already kept conformers.
+    """
+    if prot is not None:
+        prot = protein_tree(prot)
+
+        # the already present conformers are filtered the same way
+        existing = conformer_coordinates(rmol)
+        existing_ids = [conformer.GetId() for conformer in rmol.GetConformers()]
+        clashes = clashing_conformers(existing, prot, min_dst_allowed)
+        for conf_id, clash in zip(existing_ids, clashes):
+            if clash:
+                rmol.RemoveConformer(conf_id)
+
+    # the coordinates of the kept conformers, compared against each new conformer at once
+    kept_num = rmol.GetNumConformers()
+    kept_coords = np.empty((kept_num + num_conf, rmol.GetNumAtoms(), 3))
+    kept_coords[:kept_num] = conformer_coordinates(rmol)
 
-    # Generate conformers with constrained embed
     dup_count = 0
+    clash_count = 0
+    for conformer in conformers:
+        coords = conformer.GetPositions()
+        if prot is not None:
+            if clashing_conformers(coords[np.newaxis], prot, min_dst_allowed)[0]:
+                clash_count += 1
+                continue
+
+        if minimum_conf_rms and kept_num:
+            # too similar to any already generated conformers
+            if duplicate_conformers(kept_coords[:kept_num], coords, minimum_conf_rms):
+                dup_count += 1
+                continue
+
+        rmol.AddConformer(conformer, assignId=True)
+        kept_coords[kept_num] = coords
+        kept_num += 1
+    if clash_count:
+        print(f"Removed {clash_count} conformations clashing with the protein. ")
+    if dup_count:
+        print(
+            f"Removed {dup_count} duplicated conformations, leaving {rmol.GetNumConformers()} in total. "
+        )
+    return rmol
+
+
+def _embed_rdkit(
+    rmol, template_mol, coordMap, match, manmap, flexible, num_conf, randomseed
+):
+    # Generate conformers with constrained embed
     for coreI in range(num_conf):
         # temp_mol = AllChem.ConstrainedEmbed(deepcopy(mol), template_mol, useTethers=False, randomseed=random.randint(1, 9e5))
         temp_mol = ConstrainedEmbedR2(
@@ -76,16 +275,7 @@ def generate_conformers(
             flexible,
             randomseed=randomseed + coreI,
         )
-        conf_idx = rmol.AddConformer(temp_mol.GetConformer(-1), assignId=True)
-        if minimum_conf_rms is not None:
-            if duplicate_conformers(rmol, conf_idx, rms_limit=minimum_conf_rms):
-                dup_count += 1
-                rmol.RemoveConformer(conf_idx)
-    if dup_count:
-        print(
-            f"Removed {dup_count} duplicated conformations, leaving {rmol.GetNumConformers()} in total. "
-        )
-    return rmol
+        yield temp_mol.GetConformer(-1)
 
 
 from rdkit import DataStructs
@@ -168,27 +358,39 @@ def ConstrainedEmbedR2(
         # rotate the embedded conformation onto the core:
         rms = AlignMol(mol, core, atomMap=manmap)
     else:
-        # rotate the embedded conformation onto the core:
-        rms = AlignMol(mol, core, atomMap=manmap)
-        ff = getForceField(mol, confId=0)
-        conf = core.GetConformer()
-        for matchedMolI, coreI in manmap:
-            # for i in range(core.GetNumAtoms()):
-            p = conf.GetAtomPosition(coreI)
-            pIdx = ff.AddExtraPoint(p.x, p.y, p.z, fixed=True) - 1
-            ff.AddDistanceConstraint(pIdx, matchedMolI, 0, 0, 100.0 * 100)
-        ff.Initialize()
-        n = 4
-        more = ff.Minimize(energyTol=1e-4, forceTol=1e-3)
-        while more and n:
-            more = ff.Minimize(energyTol=1e-4, forceTol=1e-3)
-            n -= 1
-        # realign
-        rms = AlignMol(mol, core, atomMap=manmap)
+        rms = _tether_to_core(mol, core, manmap, confId=0, getForceField=getForceField)
     mol.SetProp("EmbedRMS", str(rms))
     return mol
 
 
+def _tether_to_core(
+    mol, core, manmap, confId=0, getForceField=UFFGetMoleculeForceField
+):
+    """
+    Pull the matched atoms of the conformer onto the core positions
+    with a minimisation that tethers them to fixed points.
+
+    :returns: The RMS of the realigned conformer.
+    """
+    # rotate the embedded conformation onto the core:
+    rms = AlignMol(mol, core, prbCid=confId, atomMap=manmap)
+    ff = getForceField(mol, confId=confId)
+    conf = core.GetConformer()
+    for matchedMolI, coreI in manmap:
+        # for i in range(core.GetNumAtoms()):
+        p = conf.GetAtomPosition(coreI)
+        pIdx = ff.AddExtraPoint(p.x, p.y, p.z, fixed=True) - 1
+        ff.AddDistanceConstraint(pIdx, matchedMolI, 0, 0, 100.0 * 100)
+    ff.Initialize()
+    n = 4
+    more = ff.Minimize(energyTol=1e-4, forceTol=1e-3)
+    while more and n:
+        more = ff.Minimize(energyTol=1e-4, forceTol=1e-3)
+        n -= 1
+    # realign
+    return AlignMol(mol, core, prbCid=confId, atomMap=manmap)
+
+
 def ConstrainedEmbedR(
     mol,
     core,
@@ -1,20 +1,24 @@
 import copy
 import itertools
 import stat
+import string
 from typing import Optional, List, Union, Tuple
 import os
 import glob
+import inspect
+import multiprocessing
 import tempfile
 import subprocess
+import sys
 import re
 from pathlib import Path
 from urllib.request import urlretrieve
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import to_hex
-from prody.proteins.functions import showProtein, view3D
 import py3Dmol
 import rdkit
 from rdkit import Chem
@@ -24,7 +28,13 @@ from rdkit.Chem import PandasTools
 import mols2grid
 import pandas
 
-from .conformers import generate_conformers
+from .conformers import (
+    generate_conformers,
+    generate_conformers_nvmolkit,
+    conformer_coordinates,
+    clashing_conformers,
+    protein_tree,
+)
 from .toxicity import tox_props
 
 # default options
@@ -185,6 +195,68 @@ def ic50(x):
     return 10 ** (-x - -9)
 
 
+def _set_pickle_properties():
+    # send the molecules with exact coordinates and all their properties
+    Chem.SetDefaultPickleProperties(
+        Chem.PropertyPickleOptions.AllProps
+        | Chem.PropertyPickleOptions.CoordsAsDouble
+    )
+
+
+def _map_processes(function, jobs, num_processes=1, start_method=None):
+    """
+    Run the function on each of the jobs, with the jobs distributed over separate processes.
+
+    Unless the start method is given, the processes are forked on Linux, and started
+    with the default method of the platform otherwise (e.g. spawned on macOS and Windows),
+    in which case the calling script has to be guarded with if __name__ == "__main__":
+
+    :param num_processes: The number of processes to use, or None for os.cpu_count().
+        With 1 process (default), the jobs are run serially in this process.
+    :param start_method: The multiprocessing start method, e.g. "spawn".
+    """
+    if num_processes is None:
+        num_processes = os.cpu_count()
+
+    if num_processes == 1 or len(jobs) < 2:
+        return [function(job) for job in jobs]
+
+    if start_method is None and sys.platform.startswith("linux"):
+        start_method = "fork"
+
+    pickle_props = Chem.GetDefaultPickleProperties()
+    _set_pickle_properties()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=min(num_processes, len(jobs)),
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_set_pickle_properties,
+        ) as executor:
+            return list(executor.map(function, jobs))
+    finally:
+        Chem.SetDefaultPickleProperties(pickle_props)
+
+
+def _generate_conformers_job(job):
+    i, rmol, num_conf, minimum_conf_rms, kwargs = job
+    print(f"RMol index {i}")
+    rmol.generate_conformers(num_conf, minimum_conf_rms, **kwargs)
+    return rmol
+
+
+def _optimise_in_receptor_job(job):
+    i, rmol, args, kwargs = job
+    print(f"RMol index {i}")
+    if kwargs.get("num_threads") and multiprocessing.parent_process() is not None:
+        # the worker processes split the CPUs, including the torch threads of ani2x
+        import torch
+
+        torch.set_num_threads(kwargs["num_threads"])
+
+    df = rmol.optimise_in_receptor(*args, **kwargs)
+    return rmol, df
+
+
 class RInterface:
     """
     This is a shared interface for a molecule and a list of molecules.
@@ -282,6 +354,14 @@ class RMol(rdkit.Chem.rdchem.Mol, RInterface):
         :param flexible: A list of indices that are common with the template molecule
             that should have new coordinates.
         :type flexible: List[int]
+        :param backend: "rdkit" (default), or "nvmolkit" to embed the conformers
+            in one batch on the GPU (requires nvMolKit).
+        :type backend: str
+        :param prot: When provided, the conformers that clash with the protein are discarded
+            as they are generated, which replaces a separate remove_clashing_confs.
+        :type prot: Prody instance, or a cKDTree of its coordinates
+        :param min_dst_allowed: The clash distance, see remove_clashing_confs.
+        :type min_dst_allowed: float in Angstroms
         """
         cons = generate_conformers(self, num_conf, minimum_conf_rms, **kwargs)
         self.RemoveAllConformers()
@@ -400,6 +480,9 @@ class RMol(rdkit.Chem.rdchem.Mol, RInterface):
         :type confIds: List[int]
         """
         if prody is not None:
+            # prody is a large import, only load it when a protein is shown
+            from prody.proteins.functions import view3D
+
             view = view3D(prody)
 
         if view is None:
@@ -438,26 +521,17 @@ class RMol(rdkit.Chem.rdchem.Mol, RInterface):
         clashes.
 
         :param prot: The protein against which the conformers should be tested.
-        :type prot: Prody instance
+        :type prot: Prody instance, or a cKDTree of its coordinates
         :param min_dst_allowed: If any atom is within this distance in a conformer, the
          conformer will be deleted.
         :type min_dst_allowed: float in Angstroms
         """
-        prot_coords = prot.getCoords()
+        coords = conformer_coordinates(self)
+        clashes = clashing_conformers(coords, protein_tree(prot), min_dst_allowed)
 
-        counter = 0
-        for conf in list(self.GetConformers())[::-1]:
-            confid = conf.GetId()
-
-            # for each atom check how far it is from the protein atoms
-            eacheach_shortest = []
-            for coord in conf.GetPositions():
-                shortest = np.min(np.sqrt(np.sum((coord - prot_coords) ** 2, axis=1)))
-                eacheach_shortest.append(shortest)
-
-            min_dst = np.min(eacheach_shortest)
-
-            if min_dst < min_dst_allowed:
+        conformer_ids = [conf.GetId() for conf in self.GetConformers()]
+        for confid, clash in reversed(list(zip(conformer_ids, clashes))):
+            if clash:
                 self.RemoveConformer(confid)
                 print(f"Clash with the protein. Removing conformer id: {confid}")
 
@@ -515,50 +589,81 @@ class RMol(rdkit.Chem.rdchem.Mol, RInterface):
         # check if it works
         subprocess.run(["./gnina", "--help"], capture_output=True, cwd=RMol.gnina_dir)
 
-    def gnina(self, receptor_file):
+    @staticmethod
+    def _run_gnina(ligand_files, receptor_file, cnn_scoring="rescore"):
         """
-        Use gnina to extract CNNaffinity, and convert it into IC50.
-
-        LIMITATION: currenly the gnina binaries do not support Mac.
+        Score the ligand files with gnina. Each file is scored by a separate
+        gnina process, with the processes running concurrently and sharing the CPUs.
+        With more than one file, the processes do not use the GPU.
 
-        :param receptor_file: Path to the receptor file.
-        :type receptor_file: str
+        :returns: The CNNaffinities in the order of the files and the ligands in them.
         """
-        self._check_download_gnina()
+        RMol._check_download_gnina()
 
         # obtain the absolute file to the receptor
         receptor = Path(receptor_file)
         if not receptor.exists():
             raise ValueError(f'Your receptor "{receptor_file}" does not seem to exist.')
 
+        # gnina parallelises a single ligand poorly, so rather split the CPUs between the processes
+        cpus = max(1, os.cpu_count() // len(ligand_files))
+
+        # each process would otherwise initialise the GPU and load its own CNN models on it
+        gpu_options = ["--no_gpu"] if len(ligand_files) > 1 else []
+
+        def run(ligand_file):
+            # run the code on the sdf
+            process = subprocess.run(
+                [
+                    "./gnina",
+                    "--score_only",
+                    "--cnn_scoring",
+                    cnn_scoring,
+                    "-l",
+                    ligand_file,
+                    "-r",
+                    receptor.absolute(),
+                    "--seed",
+                    "0",
+                    "--stripH",
+                    "False",
+                    "--cpu",
+                    str(cpus),
+                ]
+                + gpu_options,
+                capture_output=True,
+                cwd=RMol.gnina_dir,
+            )
+            output = process.stdout.decode("utf-8")
+            CNNaffinities_str = re.findall(r"CNNaffinity: (-?\d+.\d+)", output)
+
+            # convert to floats
+            return list(map(float, CNNaffinities_str))
+
+        # the threads only wait for the gnina processes
+        with ThreadPoolExecutor(max_workers=len(ligand_files)) as executor:
+            return list(itertools.chain(*executor.map(run, ligand_files)))
+
+    def gnina(self, receptor_file, cnn_scoring="rescore"):
+        """
+        Use gnina to extract CNNaffinity, and convert it into IC50.
+
+        LIMITATION: currenly the gnina binaries do not support Mac.
+
+        :param receptor_file: Path to the receptor file.
+        :type receptor_file: str
+        :param cnn_scoring: The gnina CNN scoring mode. By default, "rescore" (gnina's default),
+            which scores only the given poses with the CNN. The "refinement" and "all" modes
+            run the CNN during the optimisation too, and are slower.
+        :type cnn_scoring: str
+        """
         # make a temporary sdf file for gnina
         tmp = tempfile.NamedTemporaryFile(mode="w", suffix=".sdf")
         with Chem.SDWriter(tmp.name) as w:
             for conformer in self.GetConformers():
                 w.write(self, confId=conformer.GetId())
 
-        # run the code on the sdf
-        process = subprocess.run(
-            [
-                "./gnina",
-                "--score_only",
-                "-l",
-                tmp.name,
-                "-r",
-                receptor.absolute(),
-                "--seed",
-                "0",
-                "--stripH",
-                "False",
-            ],
-            capture_output=True,
-            cwd=RMol.gnina_dir,
-        )
-        output = process.stdout.decode("utf-8")
-        CNNaffinities_str = re.findall(r"CNNaffinity: (-?\d+.\d+)", output)
-
-        # convert to floats
-        CNNaffinities = list(map(float, CNNaffinities_str))
+        CNNaffinities = RMol._run_gnina([tmp.name], receptor_file, cnn_scoring)
 
         # generate IC50 from the CNNaffinities
         ic50s = list(map(ic50, CNNaffinities))
@@ -708,9 +813,12 @@ class RLinkerGrid(mols2grid.MolGrid):
             key=lambda smiles: smiles.replace("[*:1]", "R").replace("[*:2]", "R"),
         )
 
-        linkers = []
+        molecules = []
+        names = []
+        commons = []
         for molfile in linker_files:
             r_mol = list(Chem.SDMolSupplier(molfile, removeHs=False)).pop()
+            molecules.append(r_mol)
 
             # generate a searchable name in the form of a simple SMILE without hydrogens
             name = (
@@ -718,22 +826,22 @@ class RLinkerGrid(mols2grid.MolGrid):
                 .replace("[*:1]", "R1")
                 .replace("[*:2]", "R2")
             )
+            names.append(name)
 
-            # simplify the names for the user
-            linkers.append(
-                {
-                    "Mol": r_mol,
-                    "Name": name,
-                    "Common": r_mol.GetIntProp(
-                        "SmileIndex"
-                    ),  # extract the index property from the original publication
-                }
-            )
+            # extract the index property from the original publication
+            commons.append(r_mol.GetIntProp("SmileIndex"))
 
         # presort using the original publication index
-        linkers = sorted(linkers, key=lambda i: i["Common"])
+        order = sorted(range(len(commons)), key=commons.__getitem__)
 
-        return pandas.DataFrame(linkers)
+        # build the dataframe from the columns
+        return pandas.DataFrame(
+            {
+                "Mol": [molecules[i] for i in order],
+                "Name": [names[i] for i in order],
+                "Common": [commons[i] for i in order],
+            }
+        )
 
     def _ipython_display_(self):
         from IPython.display import display
@@ -809,30 +917,114 @@ class RList(RInterface, list):
         return df
 
     def generate_conformers(
-        self, num_conf: int, minimum_conf_rms: Optional[float] = [], **kwargs
+        self,
+        num_conf: int,
+        minimum_conf_rms: Optional[float] = [],
+        num_processes: Optional[int] = 1,
+        **kwargs,
     ):
-        for i, rmol in enumerate(self):
-            print(f"RMol index {i}")
-            rmol.generate_conformers(num_conf, minimum_conf_rms, **kwargs)
+        """
+        Generate the conformers for each molecule, see RMol.generate_conformers.
+        The molecules are independent, so they can be distributed over separate processes.
+
+        :param num_processes: The number of processes to use, or None for os.cpu_count().
+            By default, the molecules are processed one after another in this process.
+            Outside of Linux the processes are spawned, so a script using them
+            has to be guarded with if __name__ == "__main__":
+            The nvmolkit backend instead embeds the conformers of all the molecules
+            in a single GPU batch, and requires 1 process.
+        :type num_processes: int
+        """
+        if kwargs.get("prot") is not None:
+            # index the protein atoms once for all the molecules
+            kwargs["prot"] = protein_tree(kwargs["prot"])
+
+        if kwargs.get("backend") == "nvmolkit":
+            if num_processes != 1:
+                raise ValueError(
+                    "The nvmolkit backend embeds all the molecules in one GPU batch, "
+                    "please use num_processes=1. "
+                )
+
+            kwargs.pop("backend")
+            generated = generate_conformers_nvmolkit(
+                self, num_conf, minimum_conf_rms, **kwargs
+            )
+        else:
+            jobs = [
+                (i, rmol, num_conf, minimum_conf_rms, kwargs)
+                for i, rmol in enumerate(self)
+            ]
+            generated = _map_processes(_generate_conformers_job, jobs, num_processes)
+
+        # copy the conformers back as the processes worked on copies
+        for rmol, done in zip(self, generated):
+            if done is rmol:
+                continue
+
+            rmol.RemoveAllConformers()
+            [rmol.AddConformer(con, assignId=True) for con in done.GetConformers()]
 
     def GetNumConformers(self):
         return [rmol.GetNumConformers() for rmol in self]
 
     def remove_clashing_confs(self, prot, min_dst_allowed=1):
+        # index the protein atoms once for all the molecules
+        prot_tree = protein_tree(prot)
         for i, rmol in enumerate(self):
             print(f"RMol index {i}")
-            rmol.remove_clashing_confs(prot, min_dst_allowed=min_dst_allowed)
+            rmol.remove_clashing_confs(prot_tree, min_dst_allowed=min_dst_allowed)
 
-    def optimise_in_receptor(self, *args, **kwargs):
+    def optimise_in_receptor(self, *args, num_processes: Optional[int] = 1, **kwargs):
         """
         Replace the current molecule with the optimised one. Return lists of energies.
+
+        The molecules can be optimised in separate processes, see RMol.optimise_in_receptor.
+        The processes then split the CPU threads between them, and do not share
+        the parameter cache file unless a cache is given explicitly.
+
+        :param num_processes: The number of processes to use, or None for os.cpu_count().
+            By default, the molecules are optimised one after another in this process.
+            Only the CPU platform can use more than one process. The processes are spawned,
+            so a script using them has to be guarded with if __name__ == "__main__":
+        :type num_processes: int
         """
-        # return pandas.concat([m.toxicity() for m in self])
+        if num_processes is None:
+            num_processes = os.cpu_count()
+
+        if num_processes > 1 and len(self) > 1:
+            from .receptor import optimise_in_receptor
+
+            # name all the arguments, whether they were passed by name or by position
+            bound = inspect.signature(optimise_in_receptor).bind(None, *args, **kwargs)
+            kwargs = dict(bound.arguments)
+            del kwargs["ligand"]
+            args = ()
+            if kwargs.get("platform_name", "CPU").upper() != "CPU":
+                raise ValueError(
+                    "Only the CPU platform can be used with more than one process. "
+                )
+
+            # the parameter cache file cannot be shared between the processes
+            kwargs.setdefault("cache", None)
+            kwargs.setdefault(
+                "num_threads", max(1, os.cpu_count() // min(num_processes, len(self)))
+            )
+
+        jobs = [(i, rmol, args, kwargs) for i, rmol in enumerate(self)]
+        # torch and OpenMM may already run threads in this process, which are not safe to fork
+        optimised = _map_processes(
+            _optimise_in_receptor_job, jobs, num_processes, start_method="spawn"
+        )
 
         dfs = []
-        for i, rmol in enumerate(self):
-            print(f"RMol index {i}")
-            dfs.append(rmol.optimise_in_receptor(*args, **kwargs))
+        for rmol, (done, df) in zip(self, optimised):
+            # copy the optimised conformers back as the processes worked on copies
+            if done is not rmol:
+                rmol.RemoveAllConformers()
+                [rmol.AddConformer(con, assignId=True) for con in done.GetConformers()]
+                rmol._save_opt_energies(done.opt_energies)
+            dfs.append(df)
 
         df = pandas.concat(dfs)
         df.set_index(["ID", "Conformer"], inplace=True)
@@ -848,23 +1040,85 @@ class RList(RInterface, list):
         df.set_index(["ID", "Conformer"], inplace=True)
         return df
 
-    def gnina(self, receptor_file):
-        dfs = []
-        for i, rmol in enumerate(self):
-            print(f"RMol index {i}")
-            dfs.append(rmol.gnina(receptor_file))
-	
-        df = pandas.concat(dfs)
+    def gnina(
+        self,
+        receptor_file,
+        cnn_scoring="rescore",
+        num_processes: Optional[int] = 1,
+    ):
+        """
+        Score the conformers of all the molecules with gnina, see RMol.gnina.
+
+        By default, all the conformers are scored by a single gnina process, which
+        loads its CNN models only once and uses the GPU if available. With more processes,
+        the conformers are split into one file for each gnina process. These run concurrently
+        on the CPUs only (--no_gpu), which can be faster on a CPU node, but each
+        process then has to load the CNN models again.
+
+        :param num_processes: The number of concurrent gnina processes, or None for os.cpu_count().
+        :type num_processes: int
+        """
+        if num_processes is None:
+            num_processes = os.cpu_count()
+
+        conformers = [
+            (rmol, conformer.GetId())
+            for rmol in self
+            for conformer in rmol.GetConformers()
+        ]
+
+        # split the conformers in order between the processes
+        num_files = max(1, min(num_processes, len(conformers)))
+        tmps = []
+        for chunk in np.array_split(np.arange(len(conformers)), num_files):
+            tmp = tempfile.NamedTemporaryFile(mode="w", suffix=".sdf")
+            with Chem.SDWriter(tmp.name) as w:
+                for i in chunk:
+                    rmol, conformer_id = conformers[i]
+                    w.write(rmol, confId=conformer_id)
+            tmps.append(tmp)
+
+        # gnina scores the ligands in the order of the files
+        CNNaffinities = RMol._run_gnina(
+            [tmp.name for tmp in tmps], receptor_file, cnn_scoring
+        )
+
+        df = pandas.DataFrame(
+            {
+                "ID": [rmol.id for rmol, _ in conformers],
+                "Conformer": [conformer_id for _, conformer_id in conformers],
+                "CNNaffinity": CNNaffinities,
+                "CNNaffinity->IC50s": list(map(ic50, CNNaffinities)),
+            }
+        )
+
+        # count the conformers from 1
+        df["Conformer"] = df["Conformer"] + 1
         df.set_index(["ID", "Conformer"], inplace=True)
-        
-        df_reset = df.reset_index()
+        return df
 
-        # Add one to the 'Conformer' column
-        df_reset['Conformer'] = df_reset['Conformer'] + 1
+    def to_files(self, pattern: str = "best_conformers{i}.pdb"):
+        """
+        Write each molecule and all its conformers to its own file, see RMol.to_file.
 
-        # Set the index back to the original state
-        df_updated = df_reset.set_index(['ID', 'Conformer'])
-        return df_updated
+        :param pattern: The file name, with {i} replaced by the index of the molecule.
+            An sdf file name without {i} writes all the molecules into that one file instead.
+        :type pattern: str
+        """
+        # the field can have a format spec, e.g. {i:03d}
+        fields = [field for _, field, _, _ in string.Formatter().parse(pattern)]
+        if "i" in fields:
+            for i, rmol in enumerate(self):
+                rmol.to_file(pattern.format(i=i))
+        elif pattern.split(".")[-1] == "sdf":
+            with Chem.SDWriter(pattern) as w:
+                for rmol in self:
+                    for conformer in rmol.GetConformers():
+                        w.write(rmol, confId=conformer.GetId())
+        else:
+            raise ValueError(
+                f'The file name "{pattern}" must contain {{i}}, or be an sdf file. '
+            )
 
     def discard_missing(self):
         """
@@ -892,6 +1146,18 @@ class RList(RInterface, list):
         return df._repr_html_()
 
 
+def _copy_unique(mols):
+    """
+    Deep copy the molecules, copying a molecule passed more than once only once.
+    """
+    copies = {}
+    for mol in mols:
+        if id(mol) not in copies:
+            copies[id(mol)] = copy.deepcopy(mol)
+
+    return [copies[id(mol)] for mol in mols]
+
+
 def build_molecules(
     templates: Union[Chem.Mol, List[Chem.Mol]],
     r_groups: Union[Chem.Mol, List[Chem.Mol], int],
@@ -934,8 +1200,8 @@ def build_molecules(
         r_groups = [r_groups]
 
     # make a deep copy of r_groups/linkers to ensure we don't modify the library
-    templates = [copy.deepcopy(mol) for mol in templates]
-    r_groups = [copy.deepcopy(mol) for mol in r_groups]
+    templates = _copy_unique(templates)
+    r_groups = _copy_unique(r_groups)
 
     # get attachment points for each template
     if not attachment_points:
@@ -954,13 +1220,20 @@ def build_molecules(
         )
 
     combined_mols = RList()
+    merged = {}
     id_counter = 0
     for atom_idx, core_ligand in zip(attachment_points, templates):
         for r_mol in r_groups:
-            core_mol = RMol(copy.deepcopy(core_ligand))
-            merged_mol = merge_R_group(
-                mol=core_mol, R_group=r_mol, replaceIndex=atom_idx
-            )
+            # the same molecules passed more than once are merged only once
+            key = (id(core_ligand), atom_idx, id(r_mol))
+            if key in merged:
+                merged_mol = RMol(merged[key])
+            else:
+                core_mol = RMol(copy.deepcopy(core_ligand))
+                merged_mol = merge_R_group(
+                    mol=core_mol, R_group=r_mol, replaceIndex=atom_idx
+                )
+                merged[key] = merged_mol
             # assign the identifying index to the molecule
             merged_mol.id = id_counter
             combined_mols.append(merged_mol)
@@ -1,5 +1,7 @@
+import functools
+import os
 from copy import deepcopy
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import parmed
 from openmmforcefields.generators import SystemGenerator
@@ -40,6 +42,25 @@ def fix_receptor(input_file: str, output_file: str, pH: float = 7.0):
     app.PDBFile.writeFile(fixer.topology, fixer.positions, open(output_file, "w"))
 
 
+def _load_receptor(receptor_file: str):
+    """
+    Load the receptor pdb file into parmed. The receptors are cached,
+    so that optimising many molecules in the same receptor parses it only once.
+    """
+    receptor_file = os.path.abspath(receptor_file)
+    # a modified file is loaded again
+    return _load_receptor_cached(receptor_file, os.path.getmtime(receptor_file))
+
+
+@functools.lru_cache(maxsize=4)
+def _load_receptor_cached(receptor_file: str, mtime: float):
+    receptor = app.PDBFile(receptor_file)
+    parmed_receptor = parmed.openmm.load_topology(
+        receptor.topology, xyz=receptor.positions
+    )
+    return parmed_receptor
+
+
 def _can_use_ani2x(molecule: OFFMolecule) -> bool:
     """
     Check if ani2x can be used for this molecule by inspecting the elements.
@@ -88,6 +109,8 @@ def optimise_in_receptor(
     relative_permittivity: float = 4,
     water_model: str = "tip3p.xml",
     platform_name: str = "CPU",
+    cache: Optional[str] = "db.json",
+    num_threads: Optional[int] = None,
 ) -> Tuple[RMol, List[float]]:
     """
     For each of the input molecule conformers optimise the system using the chosen force field with the receptor held fixed.
@@ -111,6 +134,10 @@ def optimise_in_receptor(
         platform_name:
             The OpenMM platform name, 'cuda' if available, with the 'cpu' used by default.
             See the OpenMM documentation of Platform.
+        cache:
+            The file in which the ligand parameters are cached. If set to None, the parameters are not cached.
+        num_threads:
+            The number of CPU threads for the CPU platform. By default, all the CPUs are used.
 
     Returns:
         A copy of the input molecule with the optimised positions.
@@ -122,9 +149,12 @@ def optimise_in_receptor(
     }
 
     platform = Platform.getPlatformByName(platform_name.upper())
+    platform_properties = {}
+    if num_threads is not None and platform_name.upper() == "CPU":
+        platform_properties["Threads"] = str(num_threads)
 
     # assume the receptor has already been fixed and hydrogens have been added.
-    receptor = app.PDBFile(receptor_file)
+    parmed_receptor = _load_receptor(receptor_file)
     # receptor forcefield
     receptor_ff = "amber14/protein.ff14SB.xml"
 
@@ -139,14 +169,11 @@ def optimise_in_receptor(
     system_generator = SystemGenerator(
         forcefields=forcefields,
         small_molecule_forcefield=ligand_force_fields[ligand_force_field],
-        cache="db.json",
+        cache=cache,
         molecules=openff_mol,
     )
 
     # now make a combined receptor and ligand topology
-    parmed_receptor = parmed.openmm.load_topology(
-        receptor.topology, xyz=receptor.positions
-    )
     parmed_ligand = parmed.openmm.load_topology(
         openff_mol.to_topology().to_openmm(), xyz=openff_mol.conformers[0]
     )
@@ -187,7 +214,11 @@ def optimise_in_receptor(
 
     # set up an openmm simulation
     simulation = app.Simulation(
-        complex_structure.topology, complex_system, integrator_min, platform=platform
+        complex_structure.topology,
+        complex_system,
+        integrator_min,
+        platform=platform,
+        platformProperties=platform_properties,
     )
 
     # save the receptor coords as they should be consistent
@@ -0,0 +1,48 @@
+import pathlib
+
+import pytest
+from rdkit import Chem
+
+import fegrow
+
+root = pathlib.Path(__file__).parent
+
+
+@pytest.fixture(scope="session")
+def RGroups():
+    return fegrow.RGroups.dataframe
+
+
+@pytest.fixture(scope="session")
+def RLinkers():
+    return fegrow.RLinkers.dataframe
+
+
+@pytest.fixture(scope="session")
+def rg(RGroups):
+    # look up the R-groups by name once, rather than masking the dataframe in each test
+    by_name = dict(zip(RGroups["Name"], RGroups["Mol"]))
+    return by_name.__getitem__
+
+
+@pytest.fixture(scope="session")
+def rl(RLinkers):
+    by_name = dict(zip(RLinkers["Name"], RLinkers["Mol"]))
+    return by_name.__getitem__
+
+
+@pytest.fixture(scope="session")
+def sars_core_binary():
+    # parse the core once, and keep the exact RDKit binary which is cheap to copy from
+    core = Chem.SDMolSupplier(
+        str(root / "data" / "sarscov2_coreh.sdf"), removeHs=False
+    )[0]
+    return core.ToBinary(
+        Chem.PropertyPickleOptions.AllProps | Chem.PropertyPickleOptions.CoordsAsDouble
+    )
+
+
+@pytest.fixture
+def template_mol(sars_core_binary):
+    # a fresh copy of the core for each test
+    return Chem.Mol(sars_core_binary)
@@ -1,22 +1,22 @@
-import pathlib
+import functools
+import os
+import sys
 
+import numpy as np
+import pytest
 from rdkit import Chem
-import fegrow
-from fegrow import RGroups, RLinkers
+from scipy.spatial import cKDTree
 
-root = pathlib.Path(__file__).parent
+import fegrow
+from fegrow import _kernels, conformers, package
 
 
-def test_adding_ethanol_1mol():
+def test_adding_ethanol_1mol(rg, template_mol):
     # Check if adding one group to a molecule creates just one molecule.
-    template_mol = Chem.SDMolSupplier(
-        str(root / "data" / "sarscov2_coreh.sdf"), removeHs=False
-    )[0]
     attachment_index = [40]
 
     # get a group
-    groups = RGroups.dataframe
-    ethanol = groups.loc[groups["Name"] == "*CCO"]["Mol"].values[0]
+    ethanol = rg("*CCO")
 
     # merge
     rmols = fegrow.build_molecules(template_mol, [ethanol], attachment_index)
@@ -24,17 +24,13 @@ def test_adding_ethanol_1mol():
     assert len(rmols) == 1, "Did not generate 1 molecule"
 
 
-def test_adding_ethanol_number_of_atoms():
+def test_adding_ethanol_number_of_atoms(rg, template_mol):
     # Check if merging ethanol with a molecule yields the right number of atoms.
-    template_mol = Chem.SDMolSupplier(
-        str(root / "data" / "sarscov2_coreh.sdf"), removeHs=False
-    )[0]
     template_atoms_num = template_mol.GetNumAtoms()
     attachment_index = [40]
 
     # get a group
-    groups = RGroups.dataframe
-    ethanol = groups.loc[groups["Name"] == "*CCO"]["Mol"].values[0]
+    ethanol = rg("*CCO")
     ethanol_atoms_num = ethanol.GetNumAtoms()
 
     # merge
@@ -43,17 +39,13 @@ def test_adding_ethanol_number_of_atoms():
     assert (template_atoms_num + ethanol_atoms_num - 2) == rmols[0].GetNumAtoms()
 
 
-def test_growing_plural_groups():
+def test_growing_plural_groups(rg, template_mol):
     # Check if adding two groups to a templates creates two molecules.
-    template_mol = Chem.SDMolSupplier(
-        str(root / "data" / "sarscov2_coreh.sdf"), removeHs=False
-    )[0]
     attachment_index = [40]
 
     # get a group
-    groups = RGroups.dataframe
-    ethanol = groups.loc[groups["Name"] == "*CCO"]["Mol"].values[0]
-    cyclopropane = groups.loc[groups["Name"] == "*C1CC1"]["Mol"].values[0]
+    ethanol = rg("*CCO")
+    cyclopropane = rg("*C1CC1")
 
     # merge
     rmols = fegrow.build_molecules(
@@ -63,16 +55,12 @@ def test_growing_plural_groups():
     assert len(rmols) == 2
 
 
-def test_added_ethanol_conformer_generation():
+def test_added_ethanol_conformer_generation(rg, template_mol):
     # Check if conformers are generated correctly.
-    template_mol = Chem.SDMolSupplier(
-        str(root / "data" / "sarscov2_coreh.sdf"), removeHs=False
-    )[0]
     attachment_index = [40]
 
     # get a group
-    groups = RGroups.dataframe
-    ethanol = groups.loc[groups["Name"] == "*CCO"]["Mol"].values[0]
+    ethanol = rg("*CCO")
 
     # merge
     rmols = fegrow.build_molecules(template_mol, [ethanol], attachment_index)
@@ -84,7 +72,128 @@ def test_added_ethanol_conformer_generation():
     assert rmols[0].GetNumConformers() > 2
 
 
-def test_add_a_linker_check_star():
+def test_parallel_conformer_generation(rg, template_mol):
+    # Check if the molecules generated in separate processes match the serial ones exactly.
+    attachment_index = [40]
+    rgroups = [rg("*CCO"), rg("*C1CC1")]
+
+    serial = fegrow.build_molecules(template_mol, rgroups, attachment_index)
+    serial.generate_conformers(num_conf=10, minimum_conf_rms=0.1)
+
+    parallel = fegrow.build_molecules(template_mol, rgroups, attachment_index)
+    parallel.generate_conformers(num_conf=10, minimum_conf_rms=0.1, num_processes=2)
+
+    assert parallel.GetNumConformers() == serial.GetNumConformers()
+    for serial_mol, parallel_mol in zip(serial, parallel):
+        for serial_conf, parallel_conf in zip(
+            serial_mol.GetConformers(), parallel_mol.GetConformers()
+        ):
+            assert (serial_conf.GetPositions() == parallel_conf.GetPositions()).all()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="forks the workers")
+def test_parallel_optimise_in_receptor(rg, template_mol, monkeypatch):
+    # Check if the molecules optimised in separate processes are copied back with their energies.
+    receptor = pytest.importorskip("fegrow.receptor")
+
+    @functools.wraps(receptor.optimise_in_receptor)
+    def optimise(ligand, *args, **kwargs):
+        # the workers do not share the parameter cache, and split the CPU threads
+        assert args == () and kwargs["cache"] is None
+        opt_mol = fegrow.RMol(ligand)
+        for conformer in opt_mol.GetConformers():
+            conformer.SetPositions(conformer.GetPositions() + 1)
+        return opt_mol, [float(kwargs["num_threads"])] * opt_mol.GetNumConformers()
+
+    monkeypatch.setattr(receptor, "optimise_in_receptor", optimise)
+    # fork rather than spawn the workers, so that they run the fake optimisation
+    map_processes = package._map_processes
+    monkeypatch.setattr(
+        package,
+        "_map_processes",
+        lambda *args, start_method=None: map_processes(*args, start_method="fork"),
+    )
+
+    rmols = fegrow.build_molecules(template_mol, [rg("*CCO"), rg("*C1CC1")], [40])
+    initial = [rmol.GetConformer().GetPositions() for rmol in rmols]
+
+    with pytest.raises(ValueError):
+        rmols.optimise_in_receptor(
+            "rec.pdb", "openff", platform_name="CUDA", num_processes=2
+        )
+
+    # the receptor and the force field are passed by position
+    df = rmols.optimise_in_receptor("rec.pdb", "openff", num_processes=2)
+
+    num_threads = max(1, os.cpu_count() // 2)
+    assert list(df["Energy"]) == [num_threads, num_threads]
+    for rmol, positions in zip(rmols, initial):
+        assert (rmol.GetConformer().GetPositions() == positions + 1).all()
+        assert rmol.opt_energies == [num_threads]
+
+
+def test_nvmolkit_backend(rg, template_mol, monkeypatch):
+    # Check if the nvmolkit backend embeds all the molecules of a list in one batch.
+    from rdkit.Chem import AllChem
+
+    batches = []
+
+    def embed(mols, params, confsPerMolecule):
+        # embed on the CPU instead of the GPU
+        batches.append(len(mols))
+        for mol in mols:
+            AllChem.EmbedMultipleConfs(mol, confsPerMolecule, params)
+
+    monkeypatch.setattr(conformers, "nvEmbedMolecules", embed)
+
+    attachment_index = [40]
+    rgroups = [rg("*CCO"), rg("*C1CC1")]
+
+    single = fegrow.build_molecules(template_mol, rgroups, attachment_index)
+    for rmol in single:
+        rmol.generate_conformers(num_conf=5, backend="nvmolkit")
+
+    rmols = fegrow.build_molecules(template_mol, rgroups, attachment_index)
+    rmols.generate_conformers(num_conf=5, backend="nvmolkit")
+
+    assert batches == [1, 1, 2]
+    assert all(1 < n <= 6 for n in rmols.GetNumConformers())
+    assert rmols.GetNumConformers() == single.GetNumConformers()
+
+    with pytest.raises(ValueError):
+        rmols.generate_conformers(num_conf=5, backend="nvmolkit", num_processes=2)
+
+
+def test_generate_conformers_without_clashes(rg, template_mol):
+    # Check if discarding the clashes during the generation matches removing them afterwards.
+    attachment_index = [40]
+    ethanol = rg("*CCO")
+
+    separate = fegrow.build_molecules(template_mol, [ethanol], attachment_index)[0]
+    fused = fegrow.build_molecules(template_mol, [ethanol], attachment_index)[0]
+
+    # a protein atom on the oxygen of the initial conformer
+    oxygen = [a.GetIdx() for a in separate.GetAtoms() if a.GetSymbol() == "O"][-1]
+    initial = separate.GetConformer().GetPositions()
+    protein = cKDTree([initial[oxygen]])
+
+    separate.generate_conformers(num_conf=10)
+    generated = separate.GetNumConformers()
+    separate.remove_clashing_confs(protein, min_dst_allowed=1)
+
+    fused.generate_conformers(num_conf=10, prot=protein, min_dst_allowed=1)
+
+    assert 0 < fused.GetNumConformers() < generated
+    # the initial conformer is removed too
+    assert not any((c.GetPositions() == initial).all() for c in fused.GetConformers())
+    assert fused.GetNumConformers() == separate.GetNumConformers()
+    for separate_conf, fused_conf in zip(
+        separate.GetConformers(), fused.GetConformers()
+    ):
+        assert (separate_conf.GetPositions() == fused_conf.GetPositions()).all()
+
+
+def test_add_a_linker_check_star(RLinkers, template_mol):
     """
     1. load the core
     2. load the linker
@@ -95,13 +204,9 @@ def test_add_a_linker_check_star():
     :return:
     """
     # Check if conformers are generated correctly.
-    template_mol = Chem.SDMolSupplier(
-        str(root / "data" / "sarscov2_coreh.sdf"), removeHs=False
-    )[0]
     attachment_index = [40]
-    df = RLinkers.dataframe
     # Select a linker
-    linker = df.loc[df["mols2grid-id"] == 842]["Mol"].values[0]
+    linker = RLinkers.loc[RLinkers["mols2grid-id"] == 842]["Mol"].values[0]
     template_with_linker = fegrow.build_molecules(
         template_mol, [linker], attachment_index
     )[0]
@@ -110,19 +215,127 @@ def test_add_a_linker_check_star():
             assert len(atom.GetBonds()) == 1
 
 
-def test_two_linkers_two_rgroups():
+def test_two_linkers_two_rgroups(rg, rl):
     # Check combinatorial: ie 2 rgroups and 2 linkers create 4 molecles that contain both
 
     # get two R-groups
-    groups = RGroups.dataframe
-    R_group_ethanol = groups.loc[groups['Name'] == '*CCO']['Mol'].values[0]
-    R_group_cyclopropane = groups.loc[groups['Name'] == '*C1CC1']['Mol'].values[0]
+    R_group_ethanol = rg('*CCO')
+    R_group_cyclopropane = rg('*C1CC1')
 
     # get two linkers
-    df = RLinkers.dataframe
-    linker1 = df.loc[df['Name'] == 'R1CR2']['Mol'].values[0]
-    linker2 = df.loc[df['Name'] == 'R1CR2']['Mol'].values[0]
+    linker1 = rl('R1CR2')
+    linker2 = rl('R1CR2')
 
     built_molecules = fegrow.build_molecules([linker1, linker2], [R_group_ethanol, R_group_cyclopropane])
 
     assert len(built_molecules) == 4
+
+
+def translated_conformers(shifts):
+    # ethane with one conformer for each shift along the x axis
+    mol = fegrow.RMol(Chem.AddHs(Chem.MolFromSmiles("CC")))
+    positions = np.zeros((mol.GetNumAtoms(), 3))
+    positions[:, 1] = np.arange(mol.GetNumAtoms())
+    for shift in shifts:
+        conformer = Chem.Conformer(mol.GetNumAtoms())
+        for i, position in enumerate(positions + [shift, 0, 0]):
+            conformer.SetAtomPosition(i, position.tolist())
+        mol.AddConformer(conformer, assignId=True)
+    return mol
+
+
+def test_remove_clashing_confs():
+    # Check if only the conformers within the distance of the protein are removed.
+    mol = translated_conformers([0, 10, 20])
+
+    # a protein atom 0.5 A away from the second conformer
+    protein = cKDTree([[10, 0.5, 0]])
+    mol.remove_clashing_confs(protein, min_dst_allowed=1)
+
+    assert [c.GetId() for c in mol.GetConformers()] == [0, 2]
+
+
+def test_remove_clashing_confs_prody_list():
+    # Check if an RList filters the conformers with a prody protein, including a molecule without conformers.
+    import prody
+
+    protein = prody.AtomGroup()
+    protein.setCoords(np.array([[20, 0, 0.5], [100, 0, 0]]))
+
+    rmols = fegrow.RList([translated_conformers([0, 10, 20]), translated_conformers([])])
+    rmols.remove_clashing_confs(protein, min_dst_allowed=1)
+
+    assert [c.GetId() for c in rmols[0].GetConformers()] == [0, 1]
+    assert rmols.GetNumConformers() == [2, 0]
+
+
+@pytest.mark.skipif(not _kernels.numba_available, reason="requires numba")
+def test_duplicate_conformers_numba_matches_numpy():
+    # Check if the numba kernel finds the same duplicates as the RMS in numpy.
+    rng = np.random.default_rng(0)
+    coords = rng.normal(size=(20, 15, 3))
+    for new_coords in coords[:5] + rng.normal(scale=0.3, size=(5, 15, 3)):
+        rmslist = conformers.conformers_rms(coords, new_coords)
+        # close to the nearest conformer, but not exactly on the limit
+        for rms_limit in rmslist.min() * np.array([0.9, 0.999, 1.001, 1.1]):
+            assert _kernels.duplicate_conformer(coords, new_coords, rms_limit) == (
+                rmslist < rms_limit
+            ).any()
+
+
+def test_to_files(rg, template_mol, tmp_path):
+    # Check if the molecules are written into one file each, or all into one sdf file.
+    rmols = fegrow.build_molecules(template_mol, [rg("*CCO"), rg("*C1CC1")], [40])
+
+    rmols.to_files(str(tmp_path / "mol_{i:02d}.pdb"))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["mol_00.pdb", "mol_01.pdb"]
+
+    rmols.to_files(str(tmp_path / "all.sdf"))
+    assert len(Chem.SDMolSupplier(str(tmp_path / "all.sdf"))) == 2
+
+    with pytest.raises(ValueError):
+        rmols.to_files(str(tmp_path / "all.pdb"))
+
+
+FAKE_GNINA = """#!/bin/bash
+echo "$@" >> "$(dirname "$0")/calls"
+while [ $# -gt 0 ]; do case $1 in -l) ligands=$2; shift;; esac; shift; done
+[ -z "$ligands" ] && exit 0
+# score each record with the x coordinate of its first atom
+awk '{ if (prev == "$$$$") line = 0; line++; prev = $0 } line == 5 { print "CNNaffinity: " $1 }' "$ligands"
+"""
+
+
+@pytest.mark.parametrize("num_processes", [1, 3])
+def test_gnina_scores_order(rg, template_mol, tmp_path, monkeypatch, num_processes):
+    # Check if the scores from one or several gnina processes are matched to the right conformers.
+    gnina = tmp_path / "gnina"
+    gnina.write_text(FAKE_GNINA)
+    gnina.chmod(0o755)
+    monkeypatch.setattr(fegrow.RMol, "gnina_dir", None)
+    fegrow.RMol.set_gnina(str(gnina))
+    receptor = tmp_path / "rec.pdb"
+    receptor.touch()
+
+    rmols = fegrow.build_molecules(template_mol, [rg("*CCO"), rg("*C1CC1")], [40])
+    rmols.generate_conformers(num_conf=3)
+    for i, rmol in enumerate(rmols):
+        rmol.id = 7 + i
+
+    df = rmols.gnina(str(receptor), num_processes=num_processes)
+
+    expected = [
+        ((rmol.id, conformer.GetId() + 1), conformer.GetPositions()[0, 0])
+        for rmol in rmols
+        for conformer in rmol.GetConformers()
+    ]
+    assert list(df.index) == [index for index, _ in expected]
+    assert np.allclose(df["CNNaffinity"], [x for _, x in expected], atol=1e-4)
+
+    # the --help check, then one call for each file
+    calls = (tmp_path / "calls").read_text().splitlines()[1:]
+    assert len(calls) == num_processes
+    cpus = max(1, os.cpu_count() // num_processes)
+    for call in calls:
+        assert f"--cpu {cpus}" in call
+        assert ("--no_gpu" in call) == (num_processes > 1)
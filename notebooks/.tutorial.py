@@ -24,7 +24,6 @@
 # In[ ]:
 
 
-import prody
 from rdkit import Chem
 
 import fegrow
@@ -203,6 +202,8 @@ rmols.generate_conformers(num_conf=10,
 # In[ ]:
 
 
+import prody
+
 # get the protein-ligand complex structure
 #get_ipython().system('wget -nc https://files.rcsb.org/download/7L10.pdb')
 
@@ -297,7 +298,7 @@ final_energies = rmols.sort_conformers(energy_range=5)
 # In[ ]:
 
 
-[rmol.to_file(f"best_conformers{i}.pdb") for i, rmol in enumerate(rmols)]
+rmols.to_files("best_conformers{i}.pdb")
 
 
 # In[ ]: